@@ -1,10 +1,17 @@
+import io
+import os
+import tempfile
+import hashlib
+import pathlib
 import streamlit as st
 import yfinance as yf
 import seaborn as sns
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np  # 物理學家的好朋友
+from curl_cffi import requests as curl_requests
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
 # --- 1. 頁面設定 ---
 st.set_page_config(page_title="Alpha 實驗室", layout="centered")
@@ -17,12 +24,119 @@ st.markdown("""
 """)
 
 # --- 2. 輔助函數 ---
-def calculate_beta(stock_returns, market_returns):
-    if len(stock_returns) < 2: return 0.0
-    covariance = stock_returns.cov(market_returns)
-    variance = market_returns.var()
-    if variance == 0: return 0.0
-    return covariance / variance
+@st.cache_resource
+def get_session():
+    # 整個 server 共用同一個 session，Yahoo 的 cookie / crumb 只需要取得一次
+    return curl_requests.Session(impersonate="chrome")
+
+CACHE_DIR = pathlib.Path(__file__).parent / ".cache"
+MARKET_TZ = ZoneInfo("America/New_York")
+
+def last_session_close() -> datetime:
+    # 最近一次美股收盤 (平日 16:00 ET，非美股也以此為準)；假日不特別處理，頂多多下載一次
+    now = datetime.now(MARKET_TZ)
+    close = now.replace(hour=16, minute=0, second=0, microsecond=0)
+    if close > now: close -= timedelta(days=1)
+    while close.weekday() >= 5: close -= timedelta(days=1)
+    return close
+
+def save_closes(df: pd.DataFrame, path: pathlib.Path):
+    # 先寫暫存檔再 os.replace，別的 session 不會讀到寫一半的 parquet
+    # 寫入失敗只是少了磁碟快取，已經下載好的數據照樣回傳
+    try:
+        last_close = last_session_close()
+        CACHE_DIR.mkdir(exist_ok=True)
+        # 寫入時間早於最近一次收盤的檔案已經過期，順手清掉
+        for old in CACHE_DIR.iterdir():
+            try:
+                if old.stat().st_mtime < last_close.timestamp():
+                    old.unlink()
+            except OSError:
+                pass # 可能被別的 session 先刪掉了
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".parquet.tmp")
+        os.close(fd)
+        try:
+            df.to_parquet(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except Exception:
+        pass
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def fetch_closes(tickers_tuple: tuple[str, ...], start_iso: str) -> pd.DataFrame:
+    # 用 (代碼, 起始日) 當快取鍵：同樣的輸入在一小時內不會重複打 Yahoo
+    # 另外存一份 parquet 到磁碟，Streamlit 重啟後也不用重新下載；下一次收盤後就失效
+    key = hashlib.md5((",".join(tickers_tuple) + start_iso).encode()).hexdigest()
+    path = CACHE_DIR / f"{key}.parquet"
+    if path.exists() and path.stat().st_mtime >= last_session_close().timestamp():
+        return pd.read_parquet(path, memory_map=True)
+    df = yf.download(list(tickers_tuple), start=start_iso, progress=False,
+                     threads=True, group_by='column', session=get_session())['Close']
+    # 只留已經收盤的日線：盤中最後一列是即時價，不是收盤價
+    df = df[df.index.date <= last_session_close().date()]
+    # yfinance 下載失敗不會丟例外，只會回傳空表或整欄 NaN；這裡主動丟出，
+    # st.cache_data 不會快取例外，下次 rerun 就會重新下載
+    missing = [t for t in df.columns if df[t].isna().all()]
+    if df.empty or missing:
+        raise ValueError(f"無效或無數據的代碼: {', '.join(missing) or ', '.join(tickers_tuple)}")
+    save_closes(df, path)
+    return df
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def heatmap_png(cm: np.ndarray, labels: tuple[str, ...]) -> bytes:
+    # 熱力圖每一格都要排版數字 (O(N^2))，同一個相關矩陣只畫一次，之後直接回傳 PNG
+    fig, ax = plt.subplots(figsize=(10, 8))
+    sns.heatmap(pd.DataFrame(cm, index=labels, columns=labels), annot=True,
+                cmap='coolwarm', vmin=-1, vmax=1, center=0, fmt='.2f', ax=ax)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=200, bbox_inches='tight') # 與 st.pyplot 預設解析度一致
+    plt.close(fig)
+    return buf.getvalue()
+
+# 較重的運算用 st.cache_data 依輸入快取：切換分頁或只動某個滑桿時，沒變的步驟直接拿結果
+# 設 max_entries / ttl，避免各種參數組合永遠佔著 server 記憶體
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def compute_returns(tickers_tuple: tuple[str, ...], start_iso: str) -> tuple[np.ndarray, list[str]]:
+    # 用 (代碼, 起始日) 當快取鍵，不必每次 rerun 都雜湊整張收盤價表
+    close = fetch_closes(tickers_tuple, start_iso)
+    # 對數報酬一次算好：相關係數、Beta 都從同一個 ndarray 出發 (蒙地卡羅再用 expm1 換回簡單報酬)
+    # 先往前補值 (某檔當天沒交易就沿用前一天收盤)，之後只剩開頭還沒上市 / 還沒開始的列會是 NaN
+    P = close.ffill().to_numpy(dtype=np.float64)
+    R = np.log(P[1:] / P[:-1])
+    # 確保 C-contiguous float64 (R.flags.c_contiguous 為 True)，corrcoef / cov 才會直接走 BLAS
+    R = np.ascontiguousarray(R[~np.isnan(R).any(axis=1)], dtype=np.float64)
+    return R, list(close.columns)
+
+def compute_corr(returns: np.ndarray) -> np.ndarray:
+    # 直接丟給 NumPy (BLAS) 算 Pearson 相關係數
+    return np.atleast_2d(np.corrcoef(returns, rowvar=False))
+
+def compute_betas(returns: np.ndarray, market: np.ndarray) -> np.ndarray:
+    # 一次算完所有股票的 Beta：Beta = Cov(X, SPY) / Var(SPY)
+    Xc = returns - returns.mean(axis=0)
+    mc = market - market.mean()
+    market_var = mc @ mc
+    if market_var == 0: return np.zeros(returns.shape[1])
+    return (Xc.T @ mc) / market_var
+
+@st.cache_data(ttl=3600, max_entries=16, show_spinner=False)
+def monte_carlo(mean_returns: np.ndarray, cov_matrix: np.ndarray, num_portfolios: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    # 依 seed 一次生成所有組合的權重 (P 組 x A 檔，float32)，每一列是 Dirichlet(1) 樣本 (總和為1)
+    rng = np.random.default_rng(seed)
+    W = rng.standard_exponential((num_portfolios, len(mean_returns)), dtype=np.float32)
+    W /= W.sum(axis=1, keepdims=True)
+    mu = np.ascontiguousarray(mean_returns, dtype=np.float32)   # (A,)
+    S = np.ascontiguousarray(cov_matrix, dtype=np.float32)      # (A,A)，連續記憶體才能走 sgemm
+
+    # 預期報酬 (矩陣乘法)
+    port_ret = W @ mu                      # (P,)
+    # 預期風險 -> 這是物理學裡的 "Error Propagation" 公式：vol_i^2 = w_i^T S w_i
+    port_var = np.einsum('ij,jk,ik->i', W, S, W, optimize=True)
+    port_vol = np.sqrt(port_var)
+    sharpe = port_ret / port_vol           # Sharpe Ratio (假設無風險利率為0)
+    return np.stack([port_ret, port_vol, sharpe]), W # [報酬, 風險, Sharpe], 權重
 
 # --- 3. 側邊欄輸入 ---
 with st.sidebar:
@@ -35,25 +149,35 @@ with st.sidebar:
     st.subheader("🎲 蒙地卡羅設定")
     num_portfolios = st.slider("模擬次數 (次)", 1000, 10000, 3000)
     st.caption("模擬次數越多，運算越久，但結果越精確。")
+    seed = st.number_input("隨機種子 (seed)", min_value=0, value=0, step=1)
 
 # --- 4. 主程式邏輯 ---
 if tickers_input:
     user_tickers = [t.upper() for t in tickers_input.split()]
     
     # 為了算 Beta，我們強制加 SPY；但為了算效率前緣，我們只用使用者的股票
-    fetch_tickers = list(set(user_tickers + ["SPY"]))
+    # 排序後順序固定，快取鍵與下載欄位順序才會每次都一樣
+    fetch_tickers = sorted({*user_tickers, "SPY"})
     
     start_date = datetime.now() - timedelta(days=days_back)
     
     with st.spinner('正在從量子領域下載數據...'):
         try:
-            data = yf.download(fetch_tickers, start=start_date, progress=False)['Close']
-            returns = data.pct_change().dropna()
+            # 起始日只取到「日」，否則 datetime.now() 每次都不同會讓快取失效
+            R, cols = compute_returns(tuple(fetch_tickers), start_date.date().isoformat())
             
-            if returns.empty:
+            if len(R) == 0:
                 st.error("❌ 數據不足")
                 st.stop()
 
+            # 欄位位置只查一次，之後各分頁都用 NumPy gather (R[:, idx]) 取欄
+            # 使用者股票在 R 裡的欄位位置 (不含強制加入的 SPY)
+            user_idx = np.fromiter((cols.index(t) for t in user_tickers), dtype=np.intp)
+            # fetch_closes 保證每檔 (含 SPY) 都有數據
+            beta_tickers = list(dict.fromkeys(user_tickers))
+            beta_idx = np.fromiter((cols.index(t) for t in beta_tickers), dtype=np.intp)
+            spy_idx = cols.index('SPY')
+
             # --- Tab 分頁設計 ---
             tab1, tab2, tab3 = st.tabs(["🎲 蒙地卡羅模擬 (新功能)", "⚡ 波動率 Beta", "🔥 相關性熱力圖"])
 
@@ -65,43 +189,27 @@ if tickers_input:
                 st.markdown("我們隨機嘗試了數千種持倉比例，尋找 **夏普比率 (Sharpe Ratio)** 最高的組合。")
                 
                 # 只取使用者的股票 (不含 SPY)
-                sim_returns = returns[user_tickers]
+                # 對數報酬不能跨資產加權相加，W @ mu 要用簡單報酬才是組合的預期報酬
+                sim_returns = np.expm1(R[:, user_idx])
                 
                 if len(user_tickers) < 2:
                     st.warning("⚠️ 至少需要兩支股票才能做資產配置模擬！")
                 else:
-                    # 準備矩陣運算
-                    mean_returns = sim_returns.mean() * 252 # 年化報酬
-                    cov_matrix = sim_returns.cov() * 252    # 年化共變異數
-                    num_assets = len(user_tickers)
+                    # 準備矩陣運算：只做一次置中，一次 GEMM 同時得到平均與共變異數
+                    T = sim_returns.shape[0]
+                    mu_daily = sim_returns.mean(axis=0)
+                    Xc = sim_returns - mu_daily
+                    cov_daily = (Xc.T @ Xc) / (T - 1)
+                    mean_returns = mu_daily * 252   # 年化報酬
+                    cov_matrix = cov_daily * 252    # 年化共變異數
                     
-                    # 建立容器存放模擬結果
-                    results = np.zeros((3, num_portfolios)) # [報酬, 風險, Sharpe]
-                    weight_array = [] # 存放權重
-                    
-                    # 開始蒙地卡羅模擬 (向量化加速版)
-                    # 這裡用迴圈是因為我們要存下每一組權重，雖然可以全向量化但這樣寫比較好懂
-                    for i in range(num_portfolios):
-                        # 1. 生成隨機權重
-                        weights = np.random.random(num_assets)
-                        weights /= np.sum(weights) # 歸一化 (總和為1)
-                        weight_array.append(weights)
-                        
-                        # 2. 計算預期報酬 (矩陣乘法)
-                        portfolio_return = np.sum(mean_returns * weights)
-                        
-                        # 3. 計算預期風險 (標準差) -> 這是物理學裡的 "Error Propagation" 公式
-                        portfolio_std_dev = np.sqrt(np.dot(weights.T, np.dot(cov_matrix, weights)))
-                        
-                        # 4. 存入結果
-                        results[0,i] = portfolio_return
-                        results[1,i] = portfolio_std_dev
-                        results[2,i] = results[0,i] / results[1,i] # Sharpe Ratio (假設無風險利率為0)
+                    # 開始蒙地卡羅模擬 (全向量化版)
+                    results, W = monte_carlo(mean_returns, cov_matrix, num_portfolios, int(seed))
 
                     # 找出最強組合 (夏普比率最大)
-                    max_sharpe_idx = np.argmax(results[2])
-                    sdp, rp = results[1,max_sharpe_idx], results[0,max_sharpe_idx]
-                    optimal_weights = weight_array[max_sharpe_idx]
+                    max_sharpe_idx = int(np.argmax(results[2]))
+                    sdp, rp = float(results[1,max_sharpe_idx]), float(results[0,max_sharpe_idx])
+                    optimal_weights = W[max_sharpe_idx]
 
                     # 畫圖
                     fig_eff, ax_eff = plt.subplots(figsize=(10, 6))
@@ -113,9 +221,10 @@ if tickers_input:
                     ax_eff.set_title('Monte Carlo Simulation')
                     ax_eff.set_xlabel('Volatility (Risk)')
                     ax_eff.set_ylabel('Expected Return')
-                    plt.colorbar(sc, label='Sharpe Ratio')
+                    fig_eff.colorbar(sc, ax=ax_eff, label='Sharpe Ratio')
                     ax_eff.legend()
                     st.pyplot(fig_eff)
+                    plt.close(fig_eff) # 畫完就關掉，不然每次 rerun 的圖都會堆在 pyplot 裡吃記憶體
                     
                     # 顯示最佳配置
                     st.success(f"🏆 最佳配置 (年化報酬: {rp*100:.1f}%, 風險: {sdp*100:.1f}%)")
@@ -130,29 +239,19 @@ if tickers_input:
             # ==========================================
             with tab2:
                 st.subheader("⚡ 波動率分析 (Beta)")
-                if 'SPY' in returns.columns:
-                    market_returns = returns['SPY']
-                    beta_dict = {}
-                    for ticker in user_tickers:
-                        if ticker in returns.columns:
-                            beta_dict[ticker] = calculate_beta(returns[ticker], market_returns)
-                    
-                    beta_df = pd.Series(beta_dict).sort_values(ascending=False)
-                    st.bar_chart(beta_df, color="#FF4B4B")
-                    st.caption("基準：SPY = 1.0。數值越高代表波動越劇烈。")
-                else:
-                    st.warning("無法抓取 SPY，跳過 Beta 分析。")
+                betas = compute_betas(R[:, beta_idx], R[:, spy_idx])
+                beta_df = pd.Series(betas, index=beta_tickers, name="Beta").sort_values(ascending=False)
+                st.bar_chart(beta_df, color="#FF4B4B")
+                st.caption("基準：SPY = 1.0。數值越高代表波動越劇烈。")
 
             # ==========================================
             # 功能 3: 熱力圖
             # ==========================================
             with tab3:
                 st.subheader("🔥 相關性矩陣")
-                portfolio_returns = returns[user_tickers]
-                corr_matrix = portfolio_returns.corr()
-                fig, ax = plt.subplots(figsize=(10, 8))
-                sns.heatmap(corr_matrix, annot=True, cmap='coolwarm', vmin=-1, vmax=1, center=0, fmt='.2f')
-                st.pyplot(fig)
+                # 標籤等到畫圖時才貼上
+                cm = compute_corr(R[:, user_idx])
+                st.image(heatmap_png(cm, tuple(user_tickers)))
 
         except Exception as e:
             st.error(f"發生錯誤：{e}")